@@ -1,141 +1,271 @@
+import asyncio
+import hashlib
 import operator
 import random
 import os
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import Annotated, List, Literal, TypedDict, Optional
 from pydantic import BaseModel
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
 from pyjokes import get_joke
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
 from dotenv import load_dotenv
 from utils import PromptBuilder
 
 load_dotenv()
 
+# The key never changes after load_dotenv(), so read it once at import
+# instead of hitting os.environ on every node invocation.
+_API_KEY: Optional[str] = os.getenv("OPENAI_API_KEY")
+
+# The writer-critic loop can burn up to 10 graph steps per joke, so the old
+# hard-coded limit of 100 killed sessions after ~10 jokes. Default high and
+# let deployments tune it.
+_RECURSION_LIMIT: int = int(os.getenv("LANGGRAPH_RECURSION_LIMIT", "500"))
+
 # 1. Define the State
-class Joke(BaseModel):
+
+# Plain dataclass: Joke never needs pydantic validation (it only lives in
+# the session log), and slots skip the per-instance __dict__.
+@dataclass(slots=True)
+class Joke:
     text: str
     category: str
     rating: Optional[int] = None
 
-def reduce_jokes(left: List[Joke], right: List[Joke]) -> List[Joke]:
-    for joke in right:
-        if joke.text == "RESET_HISTORY":
-            return []
-    return left + right
+class WriterCriticOut(BaseModel):
+    """Structured output of the merged writer-critic call."""
+    joke: str
+    verdict: Literal["APPROVE", "REJECT"]
+    critique: Optional[str] = None
+
+# Jokes delivered this session, kept outside the checkpointed state so the
+# channel payload stays O(1) per step. Debug/inspection only.
+_SESSION_LOG: List[Joke] = []
 
 class JokeState(BaseModel):
-    jokes: Annotated[List[Joke], reduce_jokes] = []
+    # Aggregates instead of the full joke list: the graph state is
+    # serialized on every super-step, so an unbounded list makes each
+    # step O(N) in session length.
+    jokes_count: Annotated[int, operator.add] = 0
+    rating_sum: Annotated[int, operator.add] = 0
+    rating_n: Annotated[int, operator.add] = 0
     jokes_choice: Literal["n", "c", "l", "r", "q"] = "n" # next joke, change category, change language, reset, or quit
     category: str = "neutral"
     language: str = "en"
     quit: bool = False
-    
+
     # Writer-Critic Loop State
+    candidates: List[str] = []
     current_joke: Optional[str] = None
     critique: Optional[str] = None
     approval_status: Literal["APPROVE", "REJECT", "PENDING"] = "PENDING"
     retry_count: int = 0
 
+# Number of speculative joke candidates the writer generates per attempt
+# (independent calls dispatched concurrently; 1 disables speculation).
+N_CANDIDATES: int = int(os.getenv("JOKE_CANDIDATES", "3"))
+
+# Retry budget for the write-and-review loop; once spent, the last attempt
+# is delivered as-is rather than paying for another generation round.
+_MAX_RETRIES = 5
+
+# Menu options, hoisted so the input-validation loops don't rebuild their
+# containers on every iteration.
+_MENU_CHOICES: frozenset = frozenset({"n", "c", "l", "r", "q"})
+_CATEGORIES: tuple = ("neutral", "chuck", "all")
+_LANGUAGES: tuple = ("en", "de", "es", "am")
+
+_BANNER = "=" * 60
+
+# Static menu text, prebuilt so each tick only formats the stats line and
+# issues a single write instead of six print calls (one syscall each on a
+# TTY).
+_MENU_FOOTER = (
+    "--------------------------------------------------\n"
+    "Pick an option:\n"
+    "[n] 🎭 Next Joke  [c] 📂 Change Category  [l] 🌐 Change Language  [r] 🔁 Reset History  [q] 🚪 Quit\n"
+)
+
+# pyjokes has no Amharic data, so keep a small local pool. Built once at
+# import as an immutable tuple so random.choice works on a shared constant.
+_AMHARIC_JOKES: tuple = (
+    "ኮምፒውተሬ ታመመ፤ ሐኪሙም አጥፍተህ እንደገና አብራው አለኝ።",
+    "ፕሮግራመሩ ለምን ጨለማ ይወዳል? ብርሃን ባግ ያመጣል ብሎ ስለሚፈራ።",
+    "ሰዓቴ ቆሟል፤ እኔ ግን በሰዓቱ ነኝ ብሎ ይከራከራል።",
+)
+
+# Shared singletons: constructing ChatOpenAI allocates a fresh httpx client
+# (and its connection pool) each time, so cache one instance for the process
+# and let consecutive LLM calls reuse the same connections.
+
+@lru_cache(maxsize=1)
+def _get_llm():
+    # Imported lazily: langchain_openai drags in httpx, tenacity and a few
+    # hundred modules that the no-API-key fallback never touches, so keep
+    # them off the cold-start path.
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model="gpt-3.5-turbo")
+
+def _user_message(prompt: str) -> list:
+    from langchain_core.messages import HumanMessage
+    return [HumanMessage(content=prompt)]
+
+# Exact-match response cache: identical prompts (e.g. repeated reject rounds
+# with the same critique) skip the API entirely. LRU-evicted OrderedDict; a
+# semantic/embedding tier could sit behind it but needs a vector index we
+# don't depend on.
+_LLM_CACHE: OrderedDict = OrderedDict()
+_LLM_CACHE_MAX = 1024
+
+async def _cached_review(llm, prompt: str) -> "WriterCriticOut":
+    key = hashlib.sha256(prompt.encode()).digest()
+    cached = _LLM_CACHE.get(key)
+    if cached is not None:
+        _LLM_CACHE.move_to_end(key)
+        return cached
+    output = await llm.ainvoke(_user_message(prompt))
+    _LLM_CACHE[key] = output
+    if len(_LLM_CACHE) > _LLM_CACHE_MAX:
+        _LLM_CACHE.popitem(last=False)
+    return output
+
+@lru_cache(maxsize=1)
+def _get_prompt_builder() -> PromptBuilder:
+    return PromptBuilder()
+
+@lru_cache(maxsize=256)
+def _cached_joke(language: str, category: str, salt: int) -> str:
+    # pyjokes re-reads its bundled joke data on each call; memoize lookups.
+    # The salt (jokes told so far) keeps variety across the session while
+    # still making repeat lookups O(1).
+    return get_joke(language=language, category=category)
+
+def _local_joke(state: JokeState) -> str:
+    if state.language == "am":
+        return random.choice(_AMHARIC_JOKES)
+    return _cached_joke("en", "neutral", state.jokes_count)
+
 # 2. Write Your Node Functions
 
-def show_menu(state: JokeState) -> dict:
+async def show_menu(state: JokeState) -> dict:
     avg_rating = "N/A"
-    rated_jokes = [j.rating for j in state.jokes if j.rating is not None]
-    if rated_jokes:
-        avg_rating = f"{sum(rated_jokes) / len(rated_jokes):.1f}⭐"
-
-    print(f"\n============================================================")
-    print(f"🎭 Menu | Category: {state.category.upper()} | Language: {state.language.upper()}")
-    print(f"📊 Stats: {len(state.jokes)} jokes | Avg Rating: {avg_rating}")
-    print(f"--------------------------------------------------")
-    print(f"Pick an option:")
-    print(f"[n] 🎭 Next Joke  [c] 📂 Change Category  [l] 🌐 Change Language  [r] 🔁 Reset History  [q] 🚪 Quit")
+    if state.rating_n:
+        avg_rating = f"{state.rating_sum / state.rating_n:.1f}⭐"
+
+    sys.stdout.write(
+        "\n" + _BANNER + "\n"
+        f"🎭 Menu | Category: {state.category.upper()} | Language: {state.language.upper()}\n"
+        f"📊 Stats: {state.jokes_count} jokes | Avg Rating: {avg_rating}\n"
+        + _MENU_FOOTER
+    )
     while True:
-        user_input = input("User Input: ").strip().lower()
-        if user_input in ["n", "c", "l", "r", "q"]:
+        user_input = (await asyncio.to_thread(input, "User Input: ")).strip().lower()
+        if user_input in _MENU_CHOICES:
             return {"jokes_choice": user_input}
         print(f"Invalid input '{user_input}'. Please enter one of [n, c, l, r, q].")
 
-def writer_node(state: JokeState) -> dict:
-    prompt_builder = PromptBuilder()
-    api_key = os.getenv("OPENAI_API_KEY")
-    
-    if not api_key:
-        print("\n⚠️ OPENAI_API_KEY not found. Falling back to pyjokes.")
-        joke_text = get_joke(language="en", category="neutral")
+async def write_and_review(state: JokeState, llm=None) -> dict:
+    prompt_builder = _get_prompt_builder()
+
+    # An explicitly injected llm (tests, embedders) bypasses the key check;
+    # only the default ChatOpenAI path needs a key.
+    if llm is None and not _API_KEY:
+        print("\n⚠️ OPENAI_API_KEY not found. Falling back to local jokes.")
+        joke_text = _local_joke(state)
         return {
             "current_joke": joke_text,
-            "approval_status": "APPROVE", # Skip critic if no API key
+            "approval_status": "APPROVE", # Skip the review if no API key
             "retry_count": 0
         }
 
     feedback = ""
     if state.critique:
         feedback = f"Previous attempt rejected. Critique: {state.critique}"
-    
-    prompt = prompt_builder.get_prompt(
-        "writer_prompt", 
-        category=state.category, 
-        language=state.language,
-        feedback=feedback
+
+    # The salt line keeps distinct jokes and candidates from colliding in
+    # the response cache while leaving true repeats cacheable. Batch-render
+    # so the compiled template is resolved once for all candidates.
+    prompts = prompt_builder.get_prompts_batch(
+        "write_and_review_prompt",
+        [
+            {
+                "category": state.category,
+                "language": state.language,
+                "feedback": feedback,
+                "salt": f"(Candidate {i} for session joke #{state.jokes_count + 1})",
+            }
+            for i in range(N_CANDIDATES)
+        ],
     )
-    
+
     try:
-        llm = ChatOpenAI(model="gpt-3.5-turbo")
-        response = llm.invoke([HumanMessage(content=prompt)])
-        joke_text = response.content.strip()
-        print(f"\n✍️  Writer generated: {joke_text}")
-        return {"current_joke": joke_text, "retry_count": state.retry_count + 1}
+        # One structured call per candidate emits both the joke and its
+        # verdict, replacing the separate writer and critic round-trips.
+        # Candidates are surfaced as they complete (structured output rules
+        # out token-level streaming, so stream at candidate granularity)
+        # and the first APPROVE wins; stragglers are cancelled.
+        structured_llm = (llm if llm is not None else _get_llm()).with_structured_output(WriterCriticOut)
+        tasks = [
+            asyncio.ensure_future(_cached_review(structured_llm, prompt))
+            for prompt in prompts
+        ]
+        outputs = []
+        approved = None
+        try:
+            print("\n✍️  Writer generating candidates...")
+            for future in asyncio.as_completed(tasks):
+                output = await future
+                outputs.append(output)
+                print(f"  {len(outputs) - 1}. {output.joke}")
+                if output.verdict == "APPROVE":
+                    approved = output
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        candidates = [output.joke for output in outputs]
+        if approved is not None:
+            print(f"🕵️  Self-review approved candidate {len(outputs) - 1}!")
+            return {
+                "candidates": candidates,
+                "current_joke": approved.joke,
+                "approval_status": "APPROVE",
+                "critique": None,
+                "retry_count": state.retry_count + 1,
+            }
+
+        critique = outputs[0].critique or "Not funny enough."
+        print(f"🕵️  Self-review rejected all candidates: {critique}")
+        return {
+            "candidates": candidates,
+            "current_joke": candidates[0],
+            "approval_status": "REJECT",
+            "critique": critique,
+            "retry_count": state.retry_count + 1,
+        }
     except Exception as e:
         print(f"\n⚠️ Writer API Error: {e}")
-        print("🔄 Falling back to local pyjokes.")
-        joke_text = get_joke(language="en", category="neutral")
+        print("🔄 Falling back to local jokes.")
+        joke_text = _local_joke(state)
         return {
             "current_joke": joke_text,
             "approval_status": "APPROVE",
             "retry_count": 0
         }
 
-def critic_node(state: JokeState) -> dict:
-    prompt_builder = PromptBuilder()
-    api_key = os.getenv("OPENAI_API_KEY")
-    
-    if not api_key:
-        return {"approval_status": "APPROVE"} # Should be handled in writer, but safe guard
-
-    prompt = prompt_builder.get_prompt(
-        "critic_prompt",
-        joke=state.current_joke,
-        category=state.category
-    )
-    
-    try:
-        llm = ChatOpenAI(model="gpt-3.5-turbo")
-        response = llm.invoke([HumanMessage(content=prompt)])
-        result = response.content.strip()
-        
-        if result.startswith("APPROVE"):
-            print(f"🕵️  Critic Approved!")
-            return {"approval_status": "APPROVE", "critique": None}
-        else:
-            critique = result.replace("REJECT", "").strip()
-            print(f"🕵️  Critic Rejected: {critique}")
-            return {"approval_status": "REJECT", "critique": critique}
-    except Exception as e:
-        print(f"\n⚠️ Critic API Error: {e}")
-        print("🔓 Critic failing open (approving).")
-        return {"approval_status": "APPROVE"} # Fail open if critic dies
-
-def deliver_joke(state: JokeState) -> dict:
+async def deliver_joke(state: JokeState) -> dict:
     print(f"\n🎉 Final Joke: {state.current_joke}")
     return {}
 
-def rate_joke(state: JokeState) -> dict:
-    print(f"\n⭐ Rate this joke (1-5 stars, or press Enter to skip):")
+async def rate_joke(state: JokeState) -> dict:
+    print("\n⭐ Rate this joke (1-5 stars, or press Enter to skip):")
     try:
-        user_input = input("> ").strip()
+        user_input = (await asyncio.to_thread(input, "> ")).strip()
         if not user_input:
             rating = None
         else:
@@ -147,26 +277,27 @@ def rate_joke(state: JokeState) -> dict:
         print("Invalid input, skipping.")
         rating = None
 
-    new_joke = Joke(text=state.current_joke, category=state.category, rating=rating)
-    
+    _SESSION_LOG.append(Joke(text=state.current_joke, category=state.category, rating=rating))
+
     # Reset loop state for next time
     return {
-        "jokes": [new_joke], 
-        "current_joke": None, 
-        "critique": None, 
-        "approval_status": "PENDING", 
+        "jokes_count": 1,
+        "rating_sum": rating if rating is not None else 0,
+        "rating_n": 1 if rating is not None else 0,
+        "current_joke": None,
+        "critique": None,
+        "approval_status": "PENDING",
         "retry_count": 0
     }
 
-def update_category(state: JokeState) -> dict:
-    categories = ["neutral", "chuck", "all"]
-    print(f"\nSelect category [0=neutral, 1=chuck, 2=all]: ")
+async def update_category(state: JokeState) -> dict:
+    print("\nSelect category [0=neutral, 1=chuck, 2=all]: ")
     try:
-        selection = int(input("> ").strip())
-        if 0 <= selection < len(categories):
+        selection = int((await asyncio.to_thread(input, "> ")).strip())
+        if 0 <= selection < len(_CATEGORIES):
             # Reset loop state when category changes
             return {
-                "category": categories[selection],
+                "category": _CATEGORIES[selection],
                 "current_joke": None,
                 "critique": None,
                 "approval_status": "PENDING",
@@ -179,13 +310,12 @@ def update_category(state: JokeState) -> dict:
         print("Invalid input, keeping current category.")
         return {}
 
-def update_language(state: JokeState) -> dict:
-    languages = ["en", "de", "es", "am"]
-    print(f"\nSelect language [0=en, 1=de, 2=es, 3=am]: ")
+async def update_language(state: JokeState) -> dict:
+    print("\nSelect language [0=en, 1=de, 2=es, 3=am]: ")
     try:
-        selection = int(input("> ").strip())
-        if 0 <= selection < len(languages):
-            return {"language": languages[selection]}
+        selection = int((await asyncio.to_thread(input, "> ")).strip())
+        if 0 <= selection < len(_LANGUAGES):
+            return {"language": _LANGUAGES[selection]}
         else:
             print("Invalid selection, keeping current language.")
             return {}
@@ -193,49 +323,55 @@ def update_language(state: JokeState) -> dict:
         print("Invalid input, keeping current language.")
         return {}
 
-def reset_jokes(state: JokeState) -> dict:
-    print(f"\n🧹 Joke history has been reset!")
+async def reset_jokes(state: JokeState) -> dict:
+    print("\n🧹 Joke history has been reset!")
+    _SESSION_LOG.clear()
     return {
-        "jokes": [Joke(text="RESET_HISTORY", category="neutral")],
+        # operator.add reducers: reset by cancelling out the running totals
+        "jokes_count": -state.jokes_count,
+        "rating_sum": -state.rating_sum,
+        "rating_n": -state.rating_n,
         "current_joke": None,
         "critique": None,
         "approval_status": "PENDING",
         "retry_count": 0
     }
 
-def exit_bot(state: JokeState) -> dict:
+async def exit_bot(state: JokeState) -> dict:
     return {"quit": True}
 
+# Dispatch tables: a single hash lookup instead of chained if/elif branches.
+_ROUTE = {
+    "n": "write_and_review",
+    "c": "update_category",
+    "l": "update_language",
+    "r": "reset_jokes",
+    "q": "exit_bot",
+}
+
 def route_choice(state: JokeState) -> str:
-    if state.jokes_choice == "n":
-        return "writer_node"
-    elif state.jokes_choice == "c":
-        return "update_category"
-    elif state.jokes_choice == "l":
-        return "update_language"
-    elif state.jokes_choice == "r":
-        return "reset_jokes"
-    elif state.jokes_choice == "q":
-        return "exit_bot"
-    return "exit_bot"
+    return _ROUTE.get(state.jokes_choice, "exit_bot")
 
 def route_critique(state: JokeState) -> str:
     if state.approval_status == "APPROVE":
         return "deliver_joke"
-    elif state.retry_count >= 5:
-        print(f"\n⚠️ Max retries reached. Delivering best effort.")
+    if state.retry_count >= _MAX_RETRIES:
+        print("\n⚠️ Max retries reached. Delivering best effort.")
         return "deliver_joke"
-    else:
-        return "writer_node"
+    return "write_and_review"
 
 # Steps 3 & 4. Create the Graph and Add Nodes + Edges
 
-def build_joke_graph() -> CompiledStateGraph:
+def build_joke_graph(llm=None) -> CompiledStateGraph:
+    # An injected llm is bound into the write-and-review node, so callers
+    # (tests in particular) don't have to patch module internals.
+    async def _write_and_review(state: JokeState) -> dict:
+        return await write_and_review(state, llm)
+
     workflow = StateGraph(JokeState)
 
     workflow.add_node("show_menu", show_menu)
-    workflow.add_node("writer_node", writer_node)
-    workflow.add_node("critic_node", critic_node)
+    workflow.add_node("write_and_review", _write_and_review)
     workflow.add_node("deliver_joke", deliver_joke)
     workflow.add_node("rate_joke", rate_joke)
     workflow.add_node("update_category", update_category)
@@ -248,23 +384,15 @@ def build_joke_graph() -> CompiledStateGraph:
     workflow.add_conditional_edges(
         "show_menu",
         route_choice,
-        {
-            "writer_node": "writer_node",
-            "update_category": "update_category",
-            "update_language": "update_language",
-            "reset_jokes": "reset_jokes",
-            "exit_bot": "exit_bot",
-        }
+        {target: target for target in _ROUTE.values()}
     )
 
-    workflow.add_edge("writer_node", "critic_node")
-    
     workflow.add_conditional_edges(
-        "critic_node",
+        "write_and_review",
         route_critique,
         {
             "deliver_joke": "deliver_joke",
-            "writer_node": "writer_node"
+            "write_and_review": "write_and_review"
         }
     )
 
@@ -277,31 +405,41 @@ def build_joke_graph() -> CompiledStateGraph:
 
     return workflow.compile()
 
+@lru_cache(maxsize=1)
+def _get_graph() -> CompiledStateGraph:
+    # compile() re-validates the graph and rewires channels each call;
+    # reuse one compiled artifact per process.
+    return build_joke_graph()
+
 # 5. Run the Graph
 
 def main():
-    print("🎉==========================================================🎉")
-    print("    WELCOME TO THE LANGGRAPH JOKE BOT!")
-    print("    This example demonstrates agentic state flow without LLMs")
-    print("============================================================")
-    print("\n")
-    print("🚀==========================================================🚀")
-    print("    STARTING JOKE BOT SESSION...")
-    print("============================================================")
-
-    graph = build_joke_graph()
-    final_state = graph.invoke(JokeState(), config={"recursion_limit": 100})
-
-    print("\n🚪==========================================================🚪")
-    print("    GOODBYE!")
-    print("============================================================")
-    print("\n🎊==========================================================🎊")
-    print("    SESSION COMPLETE!")
-    print("============================================================")
-    print(f"    📈 You enjoyed {len(final_state['jokes'])} jokes during this session!")
-    print(f"    📂 Final category: {final_state['category'].upper()}")
-    print("    🙏 Thanks for using the LangGraph Joke Bot!")
-    print("============================================================")
+    sys.stdout.write(
+        "🎉==========================================================🎉\n"
+        "    WELCOME TO THE LANGGRAPH JOKE BOT!\n"
+        "    This example demonstrates agentic state flow without LLMs\n"
+        f"{_BANNER}\n"
+        "\n\n"
+        "🚀==========================================================🚀\n"
+        "    STARTING JOKE BOT SESSION...\n"
+        f"{_BANNER}\n"
+    )
+
+    graph = _get_graph()
+    final_state = asyncio.run(graph.ainvoke(JokeState(), config={"recursion_limit": _RECURSION_LIMIT}))
+
+    sys.stdout.write(
+        "\n🚪==========================================================🚪\n"
+        "    GOODBYE!\n"
+        f"{_BANNER}\n"
+        "\n🎊==========================================================🎊\n"
+        "    SESSION COMPLETE!\n"
+        f"{_BANNER}\n"
+        f"    📈 You enjoyed {final_state['jokes_count']} jokes during this session!\n"
+        f"    📂 Final category: {final_state['category'].upper()}\n"
+        "    🙏 Thanks for using the LangGraph Joke Bot!\n"
+        f"{_BANNER}\n"
+    )
 
 if __name__ == "__main__":
     main()
@@ -1,121 +1,112 @@
 
+import asyncio
+import collections
 import unittest
-from unittest.mock import MagicMock, patch
-from bot import build_joke_graph, JokeState, Joke
-from langchain_core.messages import AIMessage
+from unittest.mock import patch
+from bot import build_joke_graph, JokeState, Joke, WriterCriticOut
+
+class FakeLLM:
+    """Minimal chat-model stand-in: a plain handler function per test,
+    without MagicMock's call-recording and child-mock bookkeeping."""
+
+    def __init__(self):
+        self.handler = None
+
+    def with_structured_output(self, schema):
+        return self
+
+    async def ainvoke(self, messages):
+        return self.handler(messages)
+
+# Constant responses built once: returning the same instance per turn skips
+# a pydantic construction on every simulated LLM call.
+_APPROVED_JOKE = WriterCriticOut(
+    joke="Why did the chicken cross the road? To get to the other side!",
+    verdict="APPROVE",
+)
+_BAD_JOKE = WriterCriticOut(joke="Bad Joke", verdict="REJECT", critique="Not funny")
 
 class TestJokeBot(unittest.TestCase):
 
-    @patch('bot.ChatOpenAI')
-    @patch('bot.os.getenv')
-    def test_writer_critic_success_flow(self, mock_getenv, mock_chat_openai):
-        # Setup mocks
-        mock_getenv.return_value = "fake-api-key"
-        
-        mock_llm = MagicMock()
-        mock_chat_openai.return_value = mock_llm
-        
-        # Define side effects for the LLM to simulate Writer and Critic
-        def llm_side_effect(messages):
-            content = messages[0].content
-            if "writer_prompt" in content or "comedy writer" in content:
-                return AIMessage(content="Why did the chicken cross the road? To get to the other side!")
-            elif "critic_prompt" in content or "comedy critic" in content:
-                return AIMessage(content="APPROVE")
-            return AIMessage(content="Unknown")
-            
-        mock_llm.invoke.side_effect = llm_side_effect
-
-        # Run Graph
-        graph = build_joke_graph()
-        
-        # We need to simulate user input for the menu. 
-        # Since 'show_menu' uses input(), we should mock that too or bypass it.
-        # However, testing the whole graph end-to-end with input() is tricky.
-        # Let's test the nodes individually or mock input() to select 'n' (next joke) then 'q' (quit).
-        
-        with patch('builtins.input', side_effect=['n', '5', 'q']): 
+    @classmethod
+    def setUpClass(cls):
+        # Compile the graph once with an injected LLM; each test only
+        # rebinds the handler on the shared fake.
+        cls.llm = FakeLLM()
+        cls.graph = build_joke_graph(llm=cls.llm)
+
+    def setUp(self):
+        # Clear the module-level caches and session log between tests.
+        import bot
+        bot._get_prompt_builder.cache_clear()
+        bot._SESSION_LOG.clear()
+        bot._LLM_CACHE.clear()
+
+    def _set_llm(self, handler):
+        # write_and_review calls llm.with_structured_output(...).ainvoke,
+        # which must yield WriterCriticOut instances.
+        self.llm.handler = handler
+
+    def test_writer_critic_success_flow(self):
+        self._set_llm(lambda messages: _APPROVED_JOKE)
+
+        # Mock input() to select 'n' (next joke), rate it 5, then 'q' (quit).
+        with patch('builtins.input', side_effect=['n', '5', 'q']):
             initial_state = JokeState(category="neutral", language="en")
-            final_state = graph.invoke(initial_state)
-            
+            final_state = asyncio.run(self.graph.ainvoke(initial_state))
+
             # Assertions
-            self.assertEqual(len(final_state['jokes']), 1)
-            self.assertEqual(final_state['jokes'][0].text, "Why did the chicken cross the road? To get to the other side!")
+            import bot
+            self.assertEqual(final_state['jokes_count'], 1)
+            self.assertEqual(final_state['rating_sum'], 5)
+            self.assertEqual(final_state['rating_n'], 1)
+            self.assertEqual(bot._SESSION_LOG[-1].text, "Why did the chicken cross the road? To get to the other side!")
             self.assertEqual(final_state['approval_status'], "PENDING") # Reset after delivery
             self.assertEqual(final_state['retry_count'], 0)
 
-    @patch('bot.ChatOpenAI')
-    @patch('bot.os.getenv')
-    def test_writer_critic_retry_flow(self, mock_getenv, mock_chat_openai):
-        # Setup mocks
-        mock_getenv.return_value = "fake-api-key"
-        mock_llm = MagicMock()
-        mock_chat_openai.return_value = mock_llm
-        
-        # Scenario: Reject once, then Approve
-        # Writer called -> Joke 1
-        # Critic called -> Reject
-        # Writer called -> Joke 2
-        # Critic called -> Approve
-        
-        self.call_count = 0
-        
+    def test_writer_critic_retry_flow(self):
+        # Scenario: the first batch of candidates self-rejects, the second
+        # round approves. The first approved candidate should be delivered
+        # after 2 rounds. Queued responses instead of a call counter: the
+        # handler drains the reject queue, then approves.
+
+        rejects = collections.deque(
+            WriterCriticOut(joke=f"Joke attempt {i}", verdict="REJECT", critique="Too boring")
+            for i in (1, 2, 3)
+        )
+
         def llm_side_effect(messages):
-            content = messages[0].content
-            if "comedy writer" in content:
-                self.call_count += 1
-                return AIMessage(content=f"Joke attempt {self.call_count}")
-            elif "comedy critic" in content:
-                if self.call_count == 1:
-                    return AIMessage(content="REJECT Too boring")
-                else:
-                    return AIMessage(content="APPROVE")
-            return AIMessage(content="Unknown")
-            
-        mock_llm.invoke.side_effect = llm_side_effect
-
-        graph = build_joke_graph()
-        
+            if rejects:
+                return rejects.popleft()
+            return WriterCriticOut(joke="Recovered joke", verdict="APPROVE")
+
+        self._set_llm(llm_side_effect)
+
         with patch('builtins.input', side_effect=['n', '5', 'q']):
             initial_state = JokeState()
-            final_state = graph.invoke(initial_state)
-            
-            self.assertEqual(len(final_state['jokes']), 1)
-            self.assertEqual(final_state['jokes'][0].text, "Joke attempt 2")
-            # We expect 2 calls to writer
-            self.assertEqual(self.call_count, 2)
-
-    @patch('bot.ChatOpenAI')
-    @patch('bot.os.getenv')
-    def test_max_retries_flow(self, mock_getenv, mock_chat_openai):
-        # Setup mocks
-        mock_getenv.return_value = "fake-api-key"
-        mock_llm = MagicMock()
-        mock_chat_openai.return_value = mock_llm
-        
+            final_state = asyncio.run(self.graph.ainvoke(initial_state))
+
+            import bot
+            self.assertEqual(final_state['jokes_count'], 1)
+            self.assertEqual(bot._SESSION_LOG[-1].text, "Recovered joke")
+            # The whole first round must have been consumed before the
+            # second round's APPROVE was delivered.
+            self.assertFalse(rejects)
+
+    def test_max_retries_flow(self):
         # Scenario: Always Reject
-        
-        def llm_side_effect(messages):
-            content = messages[0].content
-            if "comedy writer" in content:
-                return AIMessage(content="Bad Joke")
-            elif "comedy critic" in content:
-                return AIMessage(content="REJECT Not funny")
-            return AIMessage(content="Unknown")
-            
-        mock_llm.invoke.side_effect = llm_side_effect
-
-        graph = build_joke_graph()
-        
+        self._set_llm(lambda messages: _BAD_JOKE)
+
         with patch('builtins.input', side_effect=['n', '5', 'q']):
             initial_state = JokeState()
-            final_state = graph.invoke(initial_state)
-            
+            final_state = asyncio.run(self.graph.ainvoke(initial_state))
+
             # Should deliver the last joke anyway after 5 retries
-            self.assertEqual(len(final_state['jokes']), 1)
-            self.assertEqual(final_state['jokes'][0].text, "Bad Joke")
-            
-            # Since we reset state after delivery, we can't check retry_count in final state directly 
+            import bot
+            self.assertEqual(final_state['jokes_count'], 1)
+            self.assertEqual(bot._SESSION_LOG[-1].text, "Bad Joke")
+
+            # Since we reset state after delivery, we can't check retry_count in final state directly
             # unless we inspect the trace, but the fact we got a joke means it passed through.
             # We can verify we didn't get stuck in infinite loop (test would timeout or fail).
 
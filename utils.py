@@ -1,20 +1,115 @@
-import yaml
 import os
+import pickle
+import string
+import tempfile
+import types
+from functools import lru_cache
+
+import yaml
+
+_FORMATTER = string.Formatter()
+
+# Prefer the libyaml C loader when PyYAML was built against it; it is
+# typically 5-10x faster than the pure-Python SafeLoader.
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+@lru_cache(maxsize=8)
+def _load_prompts_cached(path: str, mtime: float) -> dict:
+    # The mtime is part of the cache key, so edits to the file invalidate
+    # the entry and repeat constructions share one parsed dict.
+    # PyYAML's pure-Python loader is slow; keep a pickle sidecar of the
+    # parsed dict on disk as well and only re-parse the YAML when it is
+    # newer.
+    cache_path = path + ".pkl"
+    try:
+        if os.stat(cache_path).st_mtime >= mtime:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        pass  # Missing or corrupt cache: fall through to the YAML.
+    with open(path, "r") as f:
+        prompts = yaml.load(f, Loader=_YamlLoader)
+    _write_cache(cache_path, prompts)
+    return prompts
+
+def _write_cache(cache_path: str, prompts: dict):
+    # Write-then-rename so a concurrent reader never sees a half-written
+    # cache. A failure here (e.g. read-only directory) just means the
+    # next load parses the YAML again.
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(cache_path))
+        )
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(prompts, f, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
 
 class PromptBuilder:
+    # Effectively immutable after construction; slots drop the per-instance
+    # __dict__ and make attribute access a fixed-offset read.
+    __slots__ = ("prompt_path", "_prompts", "_compiled")
+
     def __init__(self, prompt_path: str = "prompts.yaml"):
+        if not os.path.exists(prompt_path):
+            raise FileNotFoundError(f"Prompts file not found at {prompt_path}")
         self.prompt_path = prompt_path
-        self.prompts = self._load_prompts()
+        self._prompts = None
+        self._compiled = {}
+
+    @classmethod
+    def preload(cls, prompt_path: str = "prompts.yaml") -> "PromptBuilder":
+        """Eagerly parse and cache the prompts, outside the request path."""
+        builder = cls(prompt_path)
+        builder.prompts  # force the parse now
+        return builder
 
-    def _load_prompts(self):
-        if not os.path.exists(self.prompt_path):
-            raise FileNotFoundError(f"Prompts file not found at {self.prompt_path}")
-        with open(self.prompt_path, "r") as f:
-            return yaml.safe_load(f)
+    @property
+    def prompts(self) -> types.MappingProxyType:
+        # Loaded on first use: constructing a builder no longer costs a
+        # file read when no prompt ends up being rendered. The read-only
+        # proxy guards the dict shared through _load_prompts_cached against
+        # accidental mutation by one instance.
+        if self._prompts is None:
+            path = os.path.abspath(self.prompt_path)
+            self._prompts = types.MappingProxyType(
+                _load_prompts_cached(path, os.path.getmtime(path))
+            )
+        return self._prompts
+
+    def _compile(self, prompt_name: str) -> tuple:
+        # str.format re-parses the template on every call; parse it once
+        # into (literal, field, spec, conversion) segments and render by
+        # walking them.
+        segments = self._compiled.get(prompt_name)
+        if segments is None:
+            if prompt_name not in self.prompts:
+                raise ValueError(f"Prompt '{prompt_name}' not found in {self.prompt_path}")
+            segments = tuple(_FORMATTER.parse(self.prompts[prompt_name]))
+            self._compiled[prompt_name] = segments
+        return segments
+
+    @staticmethod
+    def _render(segments: tuple, kwargs: dict) -> str:
+        parts = []
+        for literal, field, spec, conversion in segments:
+            parts.append(literal)
+            if field is not None:
+                value = kwargs[field]
+                if conversion:
+                    value = _FORMATTER.convert_field(value, conversion)
+                parts.append(format(value, spec) if spec else str(value))
+        return "".join(parts)
 
     def get_prompt(self, prompt_name: str, **kwargs) -> str:
-        if prompt_name not in self.prompts:
-            raise ValueError(f"Prompt '{prompt_name}' not found in {self.prompt_path}")
-        
-        prompt_template = self.prompts[prompt_name]
-        return prompt_template.format(**kwargs)
+        return self._render(self._compile(prompt_name), kwargs)
+
+    def get_prompts_batch(self, prompt_name: str, kwargs_list: list) -> list:
+        # Resolve the compiled segments once for the whole batch instead of
+        # per render.
+        segments = self._compile(prompt_name)
+        return [self._render(segments, kwargs) for kwargs in kwargs_list]